@@ -11,21 +11,35 @@ Usage:
 
 import os
 import base64
+import hashlib
 import io
+import json
+import secrets
 import time
 import asyncio
 import argparse
+import functools
 import logging
 import subprocess
 import threading
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
 from datetime import datetime
 
+# Expandable segments reduce allocator fragmentation from varying image sizes;
+# must be set before CUDA is initialized
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
+import orjson
 import torch
+import torchvision
+from cachetools import LRUCache
 from PIL import Image
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, validator
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, field_validator, model_validator
 from diffusers import FluxPipeline
 import uvicorn
 
@@ -42,42 +56,95 @@ MODEL_ID = os.environ.get("MODEL_ID", "black-forest-labs/FLUX.1-schnell")  # Fas
 # - "black-forest-labs/FLUX.1-dev" (requires auth)
 # - "stabilityai/stable-diffusion-3-medium-diffusers"
 
+# FLUX.1-schnell is timestep- and guidance-distilled for 1-4 steps and ignores CFG
+IS_SCHNELL = "schnell" in MODEL_ID.lower()
+SCHNELL_MAX_STEPS = 4
+DEFAULT_STEPS = SCHNELL_MAX_STEPS if IS_SCHNELL else (28 if "flux.1-dev" in MODEL_ID.lower() else 30)
+
+# Transformer weight quantization: "int8", "fp8" (GPU only), "bf16" or unset for fp16
+QUANT = os.environ.get("QUANT", "").lower()
+
+# Compile the transformer and VAE decoder with torch.compile (CUDA only)
+TORCH_COMPILE = os.environ.get("TORCH_COMPILE", "false").lower() == "true"
+# Number of (width, height) graph variants kept before recompiling
+COMPILE_CACHE_SIZE = int(os.environ.get("COMPILE_CACHE_SIZE", "8"))
+
+# Dynamic batching: concurrent requests with the same size/steps/guidance
+# are coalesced into a single pipeline call
+MAX_BATCH = int(os.environ.get("MAX_BATCH", "4"))
+BATCH_WAIT = 0.05  # Seconds to wait for matching requests before running a batch
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", "16"))  # Pending requests before returning 429
+
+# Images larger than this many pixels are decoded with VAE tiling
+VAE_TILING_PIXELS = 1024 * 1024
+
+# Encoded images kept for repeated fixed-seed requests
+RESULT_CACHE_SIZE = 128
+
+# Prompt embeddings are cached on CPU so repeated prompts skip the text encoders
+PROMPT_CACHE_SIZE = 256
+MAX_SEQUENCE_LENGTH = 512
+# Keep CLIP and T5 on CPU (bf16) to free ~9 GB of VRAM; only new prompts pay the encode cost
+TEXT_ENCODER_CPU = os.environ.get("TEXT_ENCODER_CPU", "false").lower() == "true"
+
 # Global variables
 pipe = None
 device = None
+model_dtype = None
+text_encoders_on_cpu = False
 model_loading_thread = None
 model_loading_started = False
 model_loading_error = None
+vae_tiling_always = False  # Set for the low-memory offload tier
+batch_queue = None  # asyncio.Queue of QueuedGeneration, created on startup
+batch_task = None
+gpu_lock = None  # asyncio.Semaphore(1) so only one batch uses the pipeline at a time
+pending = 0  # Requests queued or generating, reported by /status
+# All pipeline calls run on this one thread so CUDA work never overlaps
+inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="flux-gpu")
+_gen_cache = {}  # device -> list of MAX_BATCH reusable torch.Generators
+result_cache = LRUCache(maxsize=RESULT_CACHE_SIZE)  # request hash -> encoded image
+result_cache_lock = None
 
 # Request/Response models
 class GenerateRequest(BaseModel):
+    # Strip the prompt before min_length runs, so whitespace-only prompts are rejected
+    model_config = ConfigDict(str_strip_whitespace=True)
+    
     prompt: str = Field(..., min_length=1, max_length=1000, description="Text prompt for image generation")
-    steps: int = Field(30, ge=20, le=50, description="Number of inference steps")
-    cfg_scale: float = Field(None, ge=1.0, le=10.0, description="CFG guidance scale (alias for cfg_guidance)")
-    cfg_guidance: float = Field(None, ge=1.0, le=10.0, description="CFG guidance scale")
+    steps: int = Field(DEFAULT_STEPS, ge=1 if IS_SCHNELL else 20, le=50, description="Number of inference steps")
+    cfg_scale: Optional[float] = Field(None, ge=1.0, le=10.0, description="CFG guidance scale (alias for cfg_guidance)")
+    cfg_guidance: Optional[float] = Field(None, ge=1.0, le=10.0, description="CFG guidance scale")
     seed: int = Field(-1, ge=-1, le=999999999, description="Random seed (-1 for random)")
     width: int = Field(1024, ge=512, le=2048, description="Image width")
     height: int = Field(1024, ge=512, le=2048, description="Image height")
     
-    def __init__(self, **data):
-        # Handle both cfg_scale and cfg_guidance for backward compatibility
-        if 'cfg_scale' in data and 'cfg_guidance' not in data:
-            data['cfg_guidance'] = data['cfg_scale']
-        elif 'cfg_guidance' in data and 'cfg_scale' not in data:
-            data['cfg_scale'] = data['cfg_guidance']
-        elif 'cfg_scale' not in data and 'cfg_guidance' not in data:
-            data['cfg_scale'] = 4.0
-            data['cfg_guidance'] = 4.0
-        super().__init__(**data)
-        
-    @validator('prompt')
-    def validate_prompt(cls, v):
-        """Validate prompt is not empty and doesn't contain harmful content."""
-        if not v or not v.strip():
-            raise ValueError("Prompt cannot be empty")
-        return v.strip()
+    @model_validator(mode="before")
+    @classmethod
+    def _alias_cfg(cls, data):
+        """Handle both cfg_scale and cfg_guidance for backward compatibility."""
+        if isinstance(data, dict):
+            data = dict(data)
+            if data.get('cfg_guidance') is None:
+                data['cfg_guidance'] = data['cfg_scale'] if data.get('cfg_scale') is not None else 4.0
+            if data.get('cfg_scale') is None:
+                data['cfg_scale'] = data['cfg_guidance']
+        return data
+    
+    @field_validator('steps')
+    @classmethod
+    def clamp_steps(cls, v):
+        """Cap steps for FLUX.1-schnell; extra steps only add latency."""
+        return min(v, SCHNELL_MAX_STEPS) if IS_SCHNELL else v
+    
+    @field_validator('cfg_guidance')
+    @classmethod
+    def clamp_guidance(cls, v):
+        """FLUX.1-schnell expects guidance_scale=0."""
+        return 0.0 if IS_SCHNELL else v
         
-    @validator('width', 'height')
+    @field_validator('width', 'height')
+    @classmethod
     def validate_dimensions(cls, v):
         """Ensure dimensions are multiples of 8 for better generation."""
         if v % 8 != 0:
@@ -91,6 +158,7 @@ class GenerateResponse(BaseModel):
     image: Optional[str] = None
     error: Optional[str] = None
     duration: Optional[float] = None
+    cached: bool = False
 
 class HealthResponse(BaseModel):
     status: str
@@ -98,9 +166,54 @@ class HealthResponse(BaseModel):
     device: str
     version: str
 
+@dataclass
+class QueuedGeneration:
+    """A request waiting in the batch queue."""
+    request: GenerateRequest
+    encoder: Callable[[Any], Any]
+    future: asyncio.Future
+    progress: Optional[asyncio.Queue] = None  # Receives per-step events for streaming clients
+
+def cpu_supports_bf16():
+    """Check for native bf16 matmul on this CPU (AVX-512 BF16, AMX or the ARM BF16 extension)."""
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+def quantize_transformer(pipe, quant):
+    """Quantize the FLUX transformer weights in place with optimum-quanto."""
+    try:
+        from optimum.quanto import quantize, freeze, qint8, qfloat8
+    except ImportError:
+        logger.warning(f"QUANT={quant} requested but optimum-quanto not installed. Run: pip install optimum-quanto")
+        return
+    
+    # FP8 weights only pay off on GPUs with FP8 tensor cores (Ada/Hopper)
+    if quant == "fp8" and torch.cuda.get_device_capability(0) < (8, 9):
+        logger.warning("FP8 needs compute capability 8.9+, falling back to int8")
+        quant = "int8"
+    
+    logger.info(f"Quantizing transformer weights to {quant}...")
+    quantize(pipe.transformer, weights=qfloat8 if quant == "fp8" else qint8)
+    freeze(pipe.transformer)
+
+def compile_pipeline(pipe):
+    """Compile the transformer and VAE decoder and capture CUDA graphs at the default size."""
+    logger.info("Compiling transformer and VAE decoder with torch.compile...")
+    # Shapes are static per (width, height), so each size gets its own graph
+    torch._dynamo.config.cache_size_limit = COMPILE_CACHE_SIZE
+    pipe.transformer = torch.compile(pipe.transformer, mode="reduce-overhead", fullgraph=False, dynamic=False)
+    pipe.vae.decode = torch.compile(pipe.vae.decode, mode="reduce-overhead", fullgraph=False, dynamic=False)
+    
+    # Warm up so the first user request doesn't pay for compilation
+    logger.info("Warming up compiled pipeline (this may take a minute)...")
+    with torch.inference_mode():
+        pipe("warmup", num_inference_steps=1, width=1024, height=1024)
+
 # Initialize model
 def initialize_model():
-    global pipe, device, model_loading_error
+    global pipe, device, model_dtype, text_encoders_on_cpu, model_loading_error, vae_tiling_always
     
     try:
         # Check if we should force CPU mode (useful for Codespaces)
@@ -110,39 +223,117 @@ def initialize_model():
         
         if device == "cpu":
             logger.warning("Running on CPU - generation will be slower. Consider using a GPU for better performance.")
+            # Use physical cores only; oversubscribing SMT threads thrashes the scheduler
+            # and starves the uvicorn event loop
+            torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+            try:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                # Can only be set before any inter-op parallel work has started
+                logger.warning("Could not limit inter-op threads, parallel work already started")
         
         if device == "cuda":
             logger.info(f"GPU: {torch.cuda.get_device_name(0)}")
             logger.info(f"GPU Memory: {torch.cuda.get_device_properties(0).total_memory / 1024**3:.1f} GB")
+            
+            # Let cuDNN pick the fastest conv kernels and use TF32 tensor cores on Ampere+
+            torch.backends.cudnn.benchmark = True
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.set_float32_matmul_precision("high")
         
         logger.info("Loading FLUX model... This may take a few minutes on first run.")
         
         # Download with progress bar for better UX in Codespaces
         logger.info("Downloading model (this may take 5-10 minutes on first run)...")
         
-        pipe = FluxPipeline.from_pretrained(
+        if device == "cuda":
+            # Quantized and bf16 paths keep T5 and the non-quantized layers in bf16
+            dtype = torch.bfloat16 if QUANT in ("int8", "fp8", "bf16") else torch.float16
+        elif cpu_supports_bf16():
+            # Halves resident memory and bandwidth vs fp32 with native bf16 kernels
+            dtype = torch.bfloat16
+        else:
+            logger.warning("CPU lacks native bf16 support, loading in float32")
+            dtype = torch.float32
+        model_dtype = dtype
+        
+        pipeline = FluxPipeline.from_pretrained(
             MODEL_ID,
-            torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+            torch_dtype=dtype,
             low_cpu_mem_usage=True,  # Important for Codespaces
             cache_dir=os.environ.get("MODEL_CACHE_DIR", None)
         )
-        pipe = pipe.to(device)
+        
+        if QUANT == "int8" or (device == "cuda" and QUANT == "fp8"):
+            quantize_transformer(pipeline, QUANT)
+        
+        # Pick an offload tier from total GPU memory
+        offload = None
+        if device == "cuda":
+            total_memory = torch.cuda.get_device_properties(0).total_memory
+            if total_memory < 12 * 1024**3:
+                offload = "sequential"
+            elif total_memory < 24 * 1024**3:
+                offload = "model"
+        
+        # Offloaded pipelines stay on CPU; accelerate moves weights in on demand
+        if offload is None:
+            pipeline = pipeline.to(device)
+        
+        if device == "cuda":
+            # Channels-last improves tensor core utilization for the VAE convolutions
+            pipeline.vae.to(memory_format=torch.channels_last)
         
         # Optimize for CPU if needed
         if device == "cpu":
             logger.info("Optimizing for CPU execution...")
             # Reduce memory usage on CPU
-            if hasattr(pipe, "enable_attention_slicing"):
-                pipe.enable_attention_slicing(1)
+            if hasattr(pipeline, "enable_attention_slicing"):
+                pipeline.enable_attention_slicing(1)
+            # Use Intel Extension for PyTorch kernels (AVX-512/AMX) when installed
+            try:
+                import intel_extension_for_pytorch as ipex
+                pipeline.transformer = ipex.optimize(pipeline.transformer.eval(), dtype=pipeline.transformer.dtype)
+                logger.info("IPEX optimizations enabled for transformer")
+            except ImportError:
+                pass
+        
+        # On CUDA, attention slicing slows generation down when fused attention is
+        # available; use xFormers if installed, otherwise PyTorch 2 SDPA (the default)
+        if device == "cuda":
+            try:
+                import xformers  # noqa: F401
+                pipeline.enable_xformers_memory_efficient_attention()
+                logger.info("xFormers memory efficient attention enabled")
+            except ImportError:
+                logger.info("Using PyTorch SDPA attention")
         
-        # Enable memory efficient attention if available
-        if hasattr(pipe, "enable_attention_slicing"):
-            pipe.enable_attention_slicing()
+        # Decode batched images one at a time so multi-image batches don't OOM the VAE
+        pipeline.vae.enable_slicing()
         
         # Enable CPU offload for low memory systems
-        if device == "cuda" and torch.cuda.get_device_properties(0).total_memory < 8 * 1024**3:
-            logger.warning("Low GPU memory detected, enabling CPU offload...")
-            pipe.enable_model_cpu_offload()
+        if offload == "sequential":
+            logger.warning("Low GPU memory detected (<12 GB), enabling sequential CPU offload...")
+            pipeline.enable_sequential_cpu_offload()
+            pipeline.vae.enable_tiling()
+            vae_tiling_always = True
+        elif offload == "model":
+            logger.warning("Limited GPU memory detected (<24 GB), enabling model CPU offload...")
+            pipeline.enable_model_cpu_offload()
+        elif device == "cuda" and TORCH_COMPILE:
+            compile_pipeline(pipeline)
+        
+        # Offloaded tiers already manage encoder placement through accelerate hooks
+        if device == "cuda" and offload is None and TEXT_ENCODER_CPU:
+            logger.info("Moving text encoders to CPU...")
+            pipeline.text_encoder.to("cpu", torch.bfloat16)
+            pipeline.text_encoder_2.to("cpu", torch.bfloat16)
+            text_encoders_on_cpu = True
+            torch.cuda.empty_cache()
+        
+        # Publish last: routes treat a non-None pipe as ready
+        pipe = pipeline
         
         logger.info("Model loaded successfully!")
         logger.info("🎉 FLUX Image Generator is ready!")
@@ -161,8 +352,183 @@ def start_model_loading():
         model_loading_thread = threading.Thread(target=initialize_model, daemon=True)
         model_loading_thread.start()
 
+def batch_key(request):
+    """Requests can share a pipeline call only if these parameters match."""
+    return (request.width, request.height, request.steps, request.cfg_guidance)
+
+def encode_image(image):
+    """Encode a (C, H, W) uint8 tensor as base64 PNG."""
+    # Low zlib level: diffusion outputs barely shrink at higher levels
+    png = torchvision.io.encode_png(image, compression_level=3)
+    return base64.b64encode(png.numpy().tobytes()).decode()
+
+def encode_webp(image):
+    """Encode a (C, H, W) uint8 tensor as raw WebP bytes."""
+    buffered = io.BytesIO()
+    Image.fromarray(image.permute(1, 2, 0).numpy()).save(buffered, format="WEBP", quality=92)
+    return buffered.getvalue()
+
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def encode_prompt(prompt, max_sequence_length=MAX_SEQUENCE_LENGTH):
+    """Encode a prompt with CLIP + T5 and return (prompt_embeds, pooled_prompt_embeds) on CPU."""
+    prompt_embeds, pooled_prompt_embeds, _ = pipe.encode_prompt(
+        prompt=prompt,
+        prompt_2=None,
+        device="cpu" if text_encoders_on_cpu else None,  # None uses the pipeline's execution device
+        max_sequence_length=max_sequence_length,
+    )
+    return prompt_embeds.cpu(), pooled_prompt_embeds.cpu()
+
+def run_pipeline(requests, generators, encoders, on_step_end=None):
+    """Run one pipeline call for a batch of requests and encode each image."""
+    head = requests[0]
+    
+    # Tile the VAE decode for large images; smaller ones keep the faster untiled path
+    if head.width * head.height > VAE_TILING_PIXELS:
+        pipe.vae.enable_tiling()
+    elif not vae_tiling_always:
+        pipe.vae.disable_tiling()
+    
+    with torch.inference_mode():
+        embeds = [encode_prompt(r.prompt) for r in requests]
+        prompt_embeds = torch.cat([e for e, _ in embeds]).to(device, model_dtype)
+        pooled_prompt_embeds = torch.cat([p for _, p in embeds]).to(device, model_dtype)
+        
+        images = pipe(
+            prompt_embeds=prompt_embeds,
+            pooled_prompt_embeds=pooled_prompt_embeds,
+            num_inference_steps=head.steps,
+            guidance_scale=head.cfg_guidance,  # Use cfg_guidance which is normalized in _alias_cfg
+            generator=generators,
+            width=head.width,
+            height=head.height,
+            output_type="pt",
+            callback_on_step_end=on_step_end,
+        ).images
+        # Quantize on the device, then make a single copy of the whole batch to CPU
+        images = images.mul(255).round_().clamp_(0, 255).to(torch.uint8).cpu()
+    return [encode(image) for encode, image in zip(encoders, images)]
+
+def seed_generators(requests):
+    """Reseed the cached per-device generators in place for a batch."""
+    if device not in _gen_cache:
+        _gen_cache[device] = [torch.Generator(device=device) for _ in range(MAX_BATCH)]
+    
+    generators = _gen_cache[device][:len(requests)]
+    seeds = []
+    for generator, r in zip(generators, requests):
+        # Random seeds stay within the request's seed range so clients can send them back
+        seed = r.seed if r.seed != -1 else secrets.randbelow(10**9)
+        generator.manual_seed(seed)
+        seeds.append(seed)
+    return generators, seeds
+
+async def run_batch(batch):
+    """Generate images for a batch and resolve each request's future."""
+    requests = [item.request for item in batch]
+    encoders = [item.encoder for item in batch]
+    listeners = [item.progress for item in batch if item.progress is not None]
+    loop = asyncio.get_running_loop()
+    steps = requests[0].steps
+    
+    def on_step_end(pipeline, step, timestep, callback_kwargs):
+        # Called on the inference thread; hand events back to the event loop
+        event = {"step": step + 1, "steps": steps, "progress": round(100 * (step + 1) / steps, 1)}
+        for listener in listeners:
+            loop.call_soon_threadsafe(listener.put_nowait, event)
+        return callback_kwargs
+    
+    logger.info(f"Running batch of {len(requests)} prompt(s)")
+    try:
+        async with gpu_lock:
+            # Generators are shared, so only reseed them while holding the GPU
+            generators, seeds = seed_generators(requests)
+            # Run generation in thread pool to avoid blocking
+            encoded = await loop.run_in_executor(
+                inference_executor,
+                lambda: run_pipeline(requests, generators, encoders, on_step_end if listeners else None)
+            )
+    except Exception as e:
+        if isinstance(e, torch.cuda.OutOfMemoryError):
+            # Release cached blocks only after an OOM, not on every request
+            torch.cuda.empty_cache()
+        for item in batch:
+            if not item.future.done():
+                item.future.set_exception(e)
+        return
+    
+    for item, image, seed in zip(batch, encoded, seeds):
+        if not item.future.done():  # Client may have disconnected
+            item.future.set_result((image, seed))
+
+async def batch_worker():
+    """Drain the batch queue, grouping requests that arrive within BATCH_WAIT."""
+    loop = asyncio.get_running_loop()
+    deferred = []  # Requests that didn't match the batch they arrived during
+    
+    while True:
+        first = deferred.pop(0) if deferred else await batch_queue.get()
+        key = batch_key(first.request)
+        batch = [first]
+        
+        for item in list(deferred):
+            if len(batch) >= MAX_BATCH:
+                break
+            if batch_key(item.request) == key:
+                batch.append(item)
+                deferred.remove(item)
+        
+        deadline = loop.time() + BATCH_WAIT
+        while len(batch) < MAX_BATCH:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(batch_queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if batch_key(item.request) == key:
+                batch.append(item)
+            else:
+                deferred.append(item)
+        
+        await run_batch(batch)
+
+def result_cache_key(request, encoder):
+    """Hash the normalized generation parameters together with the output format."""
+    params = request.model_dump(exclude={"cfg_scale"})
+    params["format"] = encoder.__name__
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+async def submit_generation(request, encoder, progress=None):
+    """Queue a request for the batcher and wait for its (encoded image, seed, cached)."""
+    global pending
+    
+    # Output is deterministic for a fixed seed, so only those requests are cached
+    key = result_cache_key(request, encoder) if request.seed != -1 else None
+    if key is not None:
+        async with result_cache_lock:
+            image = result_cache.get(key)
+        if image is not None:
+            logger.info("Returning cached image")
+            return image, request.seed, True
+    
+    pending += 1
+    try:
+        future = asyncio.get_running_loop().create_future()
+        await batch_queue.put(QueuedGeneration(request, encoder, future, progress))
+        image, seed = await future
+    finally:
+        pending -= 1
+    
+    if key is not None:
+        async with result_cache_lock:
+            result_cache[key] = image
+    return image, seed, False
+
 # Create FastAPI app
-app = FastAPI(title="FLUX Krea API", version="1.0.0")
+# orjson serializes the multi-MB base64 image payloads much faster than json
+app = FastAPI(title="FLUX Krea API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Middleware for request logging
 @app.middleware("http")
@@ -196,11 +562,18 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Duration", "X-Seed", "X-Cached"],
 )
 
 @app.on_event("startup")
 async def startup_event():
-    """Start model loading in background on startup."""
+    """Start model loading and the request batcher in background on startup."""
+    global batch_queue, batch_task, gpu_lock, result_cache_lock
+    
+    batch_queue = asyncio.Queue()
+    gpu_lock = asyncio.Semaphore(1)
+    result_cache_lock = asyncio.Lock()
+    batch_task = asyncio.create_task(batch_worker())
     start_model_loading()
 
 @app.get("/")
@@ -211,6 +584,8 @@ async def root():
         "endpoints": {
             "health": "/health",
             "generate": "/generate",
+            "generate_raw": "/generate/raw",
+            "generate_stream": "/generate/stream",
             "models": "/models",
             "docs": "/docs"
         }
@@ -239,7 +614,9 @@ async def status_check():
             "models_loading": False,
             "message": "Model is ready",
             "device": str(device) if device else "unknown",
-            "model": MODEL_ID
+            "model": MODEL_ID,
+            "pending": pending,
+            "max_queue": MAX_QUEUE
         }
     elif model_loading_error:
         return {
@@ -283,47 +660,32 @@ async def generate_image(request: GenerateRequest):
             detail="Model is still loading. Please wait a moment and try again."
         )
     
+    if pending >= MAX_QUEUE:
+        raise HTTPException(
+            status_code=429,
+            detail="Server busy. Too many generations in progress, please try again shortly."
+        )
+    
     start_time = time.time()
     
     try:
-        # Set random seed if requested
-        generator = None
-        if request.seed != -1:
-            generator = torch.Generator(device=device).manual_seed(request.seed)
-        
         # Generate image
         logger.info(f"Starting image generation")
         logger.info(f"Prompt: {request.prompt[:100]}...")
         logger.info(f"Parameters: steps={request.steps}, cfg_guidance={request.cfg_guidance}, size={request.width}x{request.height}, seed={request.seed}")
         
-        with torch.no_grad():
-            # Run generation in thread pool to avoid blocking
-            loop = asyncio.get_event_loop()
-            image = await loop.run_in_executor(
-                None,
-                lambda: pipe(
-                    prompt=request.prompt,
-                    num_inference_steps=request.steps,
-                    guidance_scale=request.cfg_guidance,  # Use cfg_guidance which is normalized in __init__
-                    generator=generator,
-                    width=request.width,
-                    height=request.height,
-                ).images[0]
-            )
-        
-        # Convert to base64
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG", optimize=True)
-        img_base64 = base64.b64encode(buffered.getvalue()).decode()
+        # Queue for the batcher, which may combine this with other requests
+        img_base64, _, cached = await submit_generation(request, encode_image)
         
-        duration = time.time() - start_time
+        duration = 0.0 if cached else time.time() - start_time
         logger.info(f"Image generated successfully in {duration:.2f}s")
         logger.info(f"Image size: {len(img_base64)} bytes (base64)")
         
         return GenerateResponse(
             success=True,
             image=f"data:image/png;base64,{img_base64}",
-            duration=duration
+            duration=duration,
+            cached=cached
         )
         
     except torch.cuda.OutOfMemoryError:
@@ -351,10 +713,108 @@ async def generate_image(request: GenerateRequest):
             duration=time.time() - start_time
         )
 
+@app.post("/generate/raw")
+async def generate_image_raw(request: GenerateRequest):
+    """Generate an image and return it as WebP bytes, with metadata in headers."""
+    if pipe is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Model is still loading. Please wait a moment and try again."
+        )
+    
+    if pending >= MAX_QUEUE:
+        raise HTTPException(
+            status_code=429,
+            detail="Server busy. Too many generations in progress, please try again shortly."
+        )
+    
+    start_time = time.time()
+    
+    try:
+        image_bytes, seed, cached = await submit_generation(request, encode_webp)
+    except torch.cuda.OutOfMemoryError:
+        logger.error("GPU out of memory error")
+        raise HTTPException(
+            status_code=500,
+            detail="GPU out of memory. Try reducing image size or restarting the backend."
+        )
+    except Exception as e:
+        logger.error(f"Error generating image: {type(e).__name__}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    duration = 0.0 if cached else time.time() - start_time
+    logger.info(f"Image generated successfully in {duration:.2f}s ({len(image_bytes)} bytes)")
+    
+    return Response(
+        content=image_bytes,
+        media_type="image/webp",
+        headers={"X-Duration": f"{duration:.3f}", "X-Seed": str(seed), "X-Cached": str(cached).lower()}
+    )
+
+@app.post("/generate/stream")
+async def generate_image_stream(request: GenerateRequest):
+    """Generate an image, streaming per-step progress as server-sent events.
+    
+    Emits `progress` events with the current step, then a final `image` event
+    with the same payload as /generate, or an `error` event.
+    """
+    if pipe is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Model is still loading. Please wait a moment and try again."
+        )
+    
+    if pending >= MAX_QUEUE:
+        raise HTTPException(
+            status_code=429,
+            detail="Server busy. Too many generations in progress, please try again shortly."
+        )
+    
+    start_time = time.time()
+    progress = asyncio.Queue()
+    task = asyncio.create_task(submit_generation(request, encode_image, progress))
+    # Step events are queued before the batch resolves, so None always comes last
+    task.add_done_callback(lambda _: progress.put_nowait(None))
+    
+    async def events():
+        while (event := await progress.get()) is not None:
+            yield f"event: progress\ndata: {orjson.dumps(event).decode()}\n\n"
+        
+        try:
+            img_base64, seed, cached = task.result()
+        except torch.cuda.OutOfMemoryError:
+            logger.error("GPU out of memory error")
+            error = {"success": False, "error": "GPU out of memory. Try reducing image size or restarting the backend."}
+            yield f"event: error\ndata: {orjson.dumps(error).decode()}\n\n"
+            return
+        except Exception as e:
+            logger.error(f"Error generating image: {type(e).__name__}: {str(e)}")
+            yield f"event: error\ndata: {orjson.dumps({'success': False, 'error': str(e)}).decode()}\n\n"
+            return
+        
+        result = {
+            "success": True,
+            "image": f"data:image/png;base64,{img_base64}",
+            "seed": seed,
+            "duration": 0.0 if cached else time.time() - start_time,
+            "cached": cached
+        }
+        yield f"event: image\ndata: {orjson.dumps(result).decode()}\n\n"
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 @app.get("/models")
 async def get_models():
     """Get available models."""
-    return {"models": [MODEL_ID]}
+    return {
+        "models": [MODEL_ID],
+        "recommended_settings": {
+            "steps": DEFAULT_STEPS,
+            "max_steps": SCHNELL_MAX_STEPS if IS_SCHNELL else 50,
+            "guidance": 0.0 if IS_SCHNELL else 4.0,
+            "note": "FLUX.1-schnell requests are capped at 4 steps with guidance 0" if IS_SCHNELL else None
+        }
+    }
 
 def get_codespaces_url(port):
     """Get the public URL when running in GitHub Codespaces."""
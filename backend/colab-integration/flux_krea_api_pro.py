@@ -11,6 +11,7 @@ Usage:
 
 import os
 import gc
+import hashlib
 import base64
 import io
 import time
@@ -20,19 +21,28 @@ import logging
 import threading
 import queue
 import uuid
-from typing import Optional, List, Dict, Any
+import orjson
+import contextlib
+import importlib.util
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Any, Literal, Callable
 from datetime import datetime
 from dataclasses import dataclass, field
 
+# Must be set before torch initializes CUDA; reduces fragmentation across image sizes
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
+
 import torch
 import torch.nn as nn
-from torch.cuda.amp import autocast
+from cachetools import TTLCache
 from PIL import Image
 from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel, Field, validator
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, ValidationInfo, field_validator
 from diffusers import FluxPipeline, DiffusionPipeline
+from diffusers.models.attention_processor import FluxAttnProcessor2_0
 from transformers import T5EncoderModel, T5TokenizerFast, CLIPTextModel, CLIPTokenizer
 import uvicorn
 
@@ -43,6 +53,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# TF32 for the residual fp32 ops and cuDNN Flash for SDPA (no effect on CPU)
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+torch.set_float32_matmul_precision("high")
+if hasattr(torch.backends.cuda, "enable_cudnn_sdp"):
+    torch.backends.cuda.enable_cudnn_sdp(True)
+
 # Configuration
 class Config:
     # Model IDs
@@ -55,11 +73,17 @@ class Config:
     HOST = "0.0.0.0"
     
     # Performance settings
-    ENABLE_XFORMERS = True
+    ENABLE_SDPA = True  # PyTorch scaled_dot_product_attention (Flash / mem-efficient kernels)
+    FUSE_QKV = True  # One packed GEMM for q/k/v in every attention block
     ENABLE_VAE_SLICING = True
+    ENABLE_VAE_TILING = True
     ENABLE_CPU_OFFLOAD = False
-    USE_FLOAT16 = True
+    T5_OFFLOAD = os.environ.get("T5_OFFLOAD", "false").lower() == "true"  # Keep T5 on CPU between encodes
+    USE_BF16 = True  # FLUX's native dtype
+    USE_FP16 = os.environ.get("USE_FP16", "false").lower() == "true"  # Opt-in for GPUs without bf16 (Turing)
     TORCH_COMPILE = os.environ.get("TORCH_COMPILE", "false").lower() == "true"
+    CUDA_GRAPHS = os.environ.get("CUDA_GRAPHS", "true").lower() == "true"  # Replay compiled steps as CUDA graphs
+    QUANT = os.environ.get("QUANT", "none").lower()  # none, bnb4, int8 or fp8
     
     # Generation defaults (KREA optimized)
     DEFAULT_STEPS = 30
@@ -67,26 +91,47 @@ class Config:
     DEFAULT_WIDTH = 1024
     DEFAULT_HEIGHT = 1024
     MAX_BATCH_SIZE = 4
+    BATCH_WAIT = 0.05  # Seconds to wait for more requests to join a GPU batch
     
     # Queue settings
     MAX_QUEUE_SIZE = 50
     RESULT_CACHE_SIZE = 100
+    RESULT_TTL = 1800  # Seconds a finished request stays available on /progress
+    EMBED_CACHE_SIZE = 64
+    EMPTY_CACHE_THRESHOLD = 2 * 1024**3  # Idle reserved bytes before releasing the CUDA cache
     WORKER_THREADS = 1
+    ENCODE_THREADS = 2
 
 config = Config()
 
+MODEL_DTYPE = torch.float16 if config.USE_FP16 else (torch.bfloat16 if config.USE_BF16 else torch.float32)
+FP16_MAX = 65504.0
+
+# Resolution buckets used when compiling, so only a few static graphs are ever built
+ALLOWED_RES = (768, 1024, 1280, 1536)
+
+if config.TORCH_COMPILE:
+    try:
+        import torch.fx.experimental._config as fx_config
+        fx_config.use_duck_shape = False
+    except ImportError:
+        logger.warning("torch.fx duck-shape config not available")
+
 # Global variables
 model_manager = None
 generation_queue = queue.Queue(maxsize=config.MAX_QUEUE_SIZE)
-results_cache = {}
+# TTLCache evicts expired/oldest entries in O(1); it is not thread-safe, hence the lock
+results_cache = TTLCache(maxsize=config.RESULT_CACHE_SIZE, ttl=config.RESULT_TTL)
 cache_lock = threading.Lock()
+# PNG encoding runs here so the GPU worker can start the next batch
+encode_pool = ThreadPoolExecutor(max_workers=config.ENCODE_THREADS, thread_name_prefix="Encoder")
 
 # Data classes
 @dataclass
 class GenerationRequest:
     id: str
     prompt: str
-    params: Dict[str, Any]
+    params: "GenerateRequest"  # Frozen, so the worker can read it without copying
     status: str = "queued"
     progress: float = 0.0
     result: Optional[Dict[str, Any]] = None
@@ -94,9 +139,49 @@ class GenerationRequest:
     created_at: float = field(default_factory=time.time)
     started_at: Optional[float] = None
     completed_at: Optional[float] = None
+    image_bytes: Optional[List[bytes]] = None  # Raw PNGs for response_format="binary"
+    # Set by /generate and /progress/{id}/stream so the worker can wake them directly
+    loop: Optional[asyncio.AbstractEventLoop] = None
+    future: Optional[asyncio.Future] = None
+    progress_queue: Optional[asyncio.Queue] = None
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Current state as sent to progress streams"""
+        return {
+            'request_id': self.id,
+            'status': self.status,
+            'progress': self.progress,
+            'result': self.result,
+            'error': self.error
+        }
+    
+    def publish_progress(self):
+        """Push the current state to a progress stream, if one is attached"""
+        progress_queue = self.progress_queue
+        if progress_queue is not None:
+            self.loop.call_soon_threadsafe(progress_queue.put_nowait, self.snapshot())
+    
+    def notify_done(self):
+        """Resolve the waiting future from the worker thread"""
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(_resolve_future, self.future)
+        self.publish_progress()
+
+def _resolve_future(future: asyncio.Future):
+    # The route may have timed out and cancelled it already
+    if not future.done():
+        future.set_result(None)
+
+def snap_dimension(v: int) -> int:
+    """Round to a multiple of 8, or to the nearest bucket when compiling"""
+    if config.TORCH_COMPILE:
+        return min(ALLOWED_RES, key=lambda r: abs(r - v))
+    return (v // 8) * 8
 
 # Request/Response models
 class GenerateRequest(BaseModel):
+    model_config = ConfigDict(frozen=True, str_strip_whitespace=True)
+    
     prompt: str = Field(..., min_length=1, max_length=1000, description="Text prompt")
     steps: int = Field(config.DEFAULT_STEPS, ge=20, le=50, description="Inference steps")
     cfg_guidance: float = Field(config.DEFAULT_GUIDANCE, ge=1.0, le=10.0, description="Guidance scale")
@@ -105,20 +190,36 @@ class GenerateRequest(BaseModel):
     height: int = Field(config.DEFAULT_HEIGHT, ge=512, le=2048, description="Image height")
     negative_prompt: str = Field("", description="Negative prompt")
     num_images: int = Field(1, ge=1, le=4, description="Number of images")
+    response_format: Literal["base64", "binary"] = Field("base64", description="base64 JSON or raw image/png body")
+    
+    @field_validator('response_format')
+    @classmethod
+    def validate_response_format(cls, v, info: ValidationInfo):
+        """A raw PNG body can only carry one image"""
+        if v == "binary" and info.data.get('num_images', 1) > 1:
+            raise ValueError("response_format=binary supports a single image")
+        return v
     
-    @validator('width', 'height')
+    @field_validator('width', 'height')
+    @classmethod
     def validate_dimensions(cls, v):
         """Ensure dimensions are multiples of 8"""
-        return (v // 8) * 8
+        return snap_dimension(v)
 
 class BatchGenerateRequest(BaseModel):
-    prompts: List[str] = Field(..., min_items=1, max_items=config.MAX_BATCH_SIZE)
+    prompts: List[str] = Field(..., min_length=1, max_length=config.MAX_BATCH_SIZE)
     steps: int = Field(config.DEFAULT_STEPS, ge=20, le=50)
     cfg_guidance: float = Field(config.DEFAULT_GUIDANCE, ge=1.0, le=10.0)
     seed: int = Field(-1)
     width: int = Field(config.DEFAULT_WIDTH, ge=512, le=2048)
     height: int = Field(config.DEFAULT_HEIGHT, ge=512, le=2048)
     negative_prompt: str = Field("")
+    
+    @field_validator('width', 'height')
+    @classmethod
+    def validate_dimensions(cls, v):
+        """Ensure dimensions are multiples of 8"""
+        return snap_dimension(v)
 
 class GenerateResponse(BaseModel):
     success: bool
@@ -144,11 +245,17 @@ class FluxKreaModelManager:
         self.pipe = None
         self.t5_encoder = None
         self.t5_tokenizer = None
+        self.t5_hook = None
         self.clip_model = None
         self.clip_tokenizer = None
         self.model_loaded = False
+        self.pipeline_ready = False  # Warmup may run the pipe before requests are accepted
         self.loading_progress = 0
         self.loading_status = "Not started"
+        self.embed_cache = OrderedDict()
+        self.embed_lock = threading.Lock()
+        # Reused across calls (re-seeded per request); one per batch slot
+        self.generators = [torch.Generator(device=self.device) for _ in range(config.MAX_BATCH_SIZE)]
         
     def load_t5_xxl(self):
         """Load T5-v1.1-XXL for superior text encoding"""
@@ -164,22 +271,14 @@ class FluxKreaModelManager:
                 legacy=False
             )
             
-            # Load model with optimizations
+            # Load model with optimizations (offloaded T5 stays on CPU, see offload_t5)
             self.t5_encoder = T5EncoderModel.from_pretrained(
                 config.T5_MODEL,
-                torch_dtype=torch.float16 if config.USE_FLOAT16 else torch.float32,
-                device_map="auto",
+                torch_dtype=MODEL_DTYPE,
+                device_map=None if config.T5_OFFLOAD else "auto",
                 low_cpu_mem_usage=True
             )
             
-            # Enable xFormers if available
-            if config.ENABLE_XFORMERS and self.device == "cuda":
-                try:
-                    self.t5_encoder.enable_xformers_memory_efficient_attention()
-                    logger.info("xFormers enabled for T5")
-                except:
-                    logger.warning("xFormers not available for T5")
-            
             self.loading_progress = 30
             logger.info("T5-XXL loaded successfully")
             return True
@@ -199,7 +298,7 @@ class FluxKreaModelManager:
             self.clip_tokenizer = CLIPTokenizer.from_pretrained(config.CLIP_MODEL)
             self.clip_model = CLIPTextModel.from_pretrained(
                 config.CLIP_MODEL,
-                torch_dtype=torch.float16 if config.USE_FLOAT16 else torch.float32
+                torch_dtype=MODEL_DTYPE
             ).to(self.device)
             
             self.loading_progress = 50
@@ -218,45 +317,91 @@ class FluxKreaModelManager:
         self.loading_progress = 60
         
         try:
+            # 4-bit weights have to be quantized while loading
+            extra_components = {}
+            if config.QUANT == "bnb4":
+                transformer = self.load_bnb4_transformer()
+                if transformer is not None:
+                    extra_components['transformer'] = transformer
+            
             # Load FLUX with custom encoders
             self.pipe = FluxPipeline.from_pretrained(
                 config.MODEL_ID,
-                text_encoder=self.t5_encoder,
-                text_encoder_2=self.clip_model,
-                tokenizer=self.t5_tokenizer,
-                tokenizer_2=self.clip_tokenizer,
-                torch_dtype=torch.float16 if config.USE_FLOAT16 else torch.float32,
+                **extra_components,
+                # FluxPipeline slots: CLIP first, T5 second (encode_prompt relies on this)
+                text_encoder=self.clip_model,
+                text_encoder_2=self.t5_encoder,
+                tokenizer=self.clip_tokenizer,
+                tokenizer_2=self.t5_tokenizer,
+                torch_dtype=MODEL_DTYPE,
                 use_safetensors=True,
-                variant="fp16" if config.USE_FLOAT16 else None
+                variant="fp16" if config.USE_FP16 else None
             )
             
-            self.pipe = self.pipe.to(self.device)
+            if config.QUANT in ("int8", "fp8"):
+                self.quantize_transformer(config.QUANT)
+            
+            t5_offload = config.T5_OFFLOAD and self.device == "cuda" and not config.ENABLE_CPU_OFFLOAD
+            if t5_offload:
+                # Hook T5-XXL before moving anything, so it never sits on the GPU during load
+                self.offload_t5()
+                for component in self.pipe.components.values():
+                    if isinstance(component, torch.nn.Module) and component is not self.t5_encoder:
+                        component.to(self.device)
+            else:
+                self.pipe = self.pipe.to(self.device)
+            if config.USE_FP16:
+                self.clip_fp16_activations()
+            if self.device == "cuda":
+                self.pipe.transformer.to(memory_format=torch.channels_last)
+                self.pipe.vae.to(memory_format=torch.channels_last)
             self.loading_progress = 80
             
             # Apply optimizations
-            if config.ENABLE_XFORMERS and self.device == "cuda":
-                try:
-                    self.pipe.enable_xformers_memory_efficient_attention()
-                    logger.info("xFormers enabled - 50% memory reduction")
-                except:
-                    logger.warning("xFormers not available")
+            if config.ENABLE_SDPA:
+                self.pipe.transformer.set_attn_processor(FluxAttnProcessor2_0())
+                logger.info("SDPA attention enabled (FlashAttention kernels)")
+            
+            # Packing quantized weights is not supported, so only fuse full-precision layers
+            if config.FUSE_QKV and config.QUANT == "none":
+                self.pipe.transformer.fuse_qkv_projections()
+                logger.info("Fused q/k/v projections")
             
             if config.ENABLE_VAE_SLICING:
                 self.pipe.enable_vae_slicing()
                 logger.info("VAE slicing enabled for HD images")
             
+            # Tiles only kick in above the VAE's native 1024px tile, so 1024² keeps the single-pass decode
+            if config.ENABLE_VAE_TILING:
+                self.pipe.vae.enable_tiling()
+                logger.info("VAE tiling enabled for >1024px images")
+            
             if config.ENABLE_CPU_OFFLOAD:
                 self.pipe.enable_model_cpu_offload()
                 logger.info("CPU offload enabled")
             
-            # Compile with Torch 2.0
+            # Compile with Torch 2.0 (FLUX is a DiT, so compile the transformer)
             if config.TORCH_COMPILE and hasattr(torch, 'compile'):
-                logger.info("Compiling model with Torch 2.0...")
-                self.pipe.unet = torch.compile(self.pipe.unet, mode="reduce-overhead")
+                logger.info("Compiling transformer with Torch 2.0...")
+                # One graph per (width, height, batch size); keep them all instead of falling back to eager
+                torch._dynamo.config.cache_size_limit = len(ALLOWED_RES) ** 2 * config.MAX_BATCH_SIZE
+                if config.CUDA_GRAPHS:
+                    torch._inductor.config.triton.cudagraphs = True
+                self.pipe.transformer = torch.compile(
+                    self.pipe.transformer,
+                    mode="reduce-overhead" if config.CUDA_GRAPHS else "max-autotune-no-cudagraphs",
+                    fullgraph=True,
+                    dynamic=False
+                )
+                # Fuses the decoder's upsample/conv/GroupNorm/SiLU chains; tiled decodes break the graph
+                self.pipe.vae.decode = torch.compile(
+                    self.pipe.vae.decode,
+                    mode="max-autotune" if config.CUDA_GRAPHS else "max-autotune-no-cudagraphs",
+                    fullgraph=False
+                )
             
             self.loading_progress = 100
-            self.loading_status = "Ready"
-            self.model_loaded = True
+            self.pipeline_ready = True
             
             logger.info("FLUX pipeline ready with T5-XXL + CLIP!")
             return True
@@ -266,6 +411,52 @@ class FluxKreaModelManager:
             self.loading_status = f"FLUX Error: {str(e)}"
             return False
     
+    def load_bnb4_transformer(self):
+        """Load the FLUX transformer with NF4 bitsandbytes weights"""
+        try:
+            from diffusers import FluxTransformer2DModel, BitsAndBytesConfig
+        except ImportError:
+            logger.warning("QUANT=bnb4 needs diffusers>=0.31 and bitsandbytes. Run: pip install bitsandbytes")
+            return None
+        
+        logger.info("Loading transformer with 4-bit NF4 weights...")
+        return FluxTransformer2DModel.from_pretrained(
+            config.MODEL_ID,
+            subfolder="transformer",
+            quantization_config=BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16
+            ),
+            torch_dtype=torch.bfloat16
+        )
+    
+    def quantize_transformer(self, quant: str):
+        """Quantize the FLUX transformer weights in place with optimum-quanto"""
+        try:
+            from optimum.quanto import quantize, freeze, qint8, qfloat8
+        except ImportError:
+            logger.warning(f"QUANT={quant} requested but optimum-quanto not installed. Run: pip install optimum-quanto")
+            return
+        
+        # FP8 weights only pay off on GPUs with FP8 tensor cores (Ada/Hopper/Blackwell)
+        if quant == "fp8" and (self.device != "cuda" or torch.cuda.get_device_capability(0) < (8, 9)):
+            logger.warning("FP8 needs compute capability 8.9+, falling back to int8")
+            quant = "int8"
+        
+        logger.info(f"Quantizing transformer weights to {quant}...")
+        quantize(self.pipe.transformer, weights=qfloat8 if quant == "fp8" else qint8)
+        freeze(self.pipe.transformer)
+    
+    def offload_t5(self):
+        """Keep T5-XXL on CPU and move it to the GPU only while encoding"""
+        from accelerate import cpu_offload_with_hook
+        
+        self.t5_encoder.to("cpu")
+        _, self.t5_hook = cpu_offload_with_hook(self.t5_encoder, execution_device=self.device)
+        torch.cuda.empty_cache()
+        logger.info("T5-XXL offloaded to CPU between prompt encodes")
+    
     def load_all(self):
         """Load all models"""
         success = (
@@ -274,22 +465,114 @@ class FluxKreaModelManager:
             self.load_flux_pipeline()
         )
         
+        if success and config.TORCH_COMPILE:
+            # Before model_loaded is set, so no request races the warmup
+            try:
+                self.warmup()
+            except Exception as e:
+                logger.error(f"Error warming up: {e}")
+                self.loading_status = f"Warmup Error: {str(e)}"
+                success = False
+        
         if success:
-            self.optimize_memory()
+            self.loading_status = "Ready"
+            self.model_loaded = True
+            self.optimize_memory(force=True)
             logger.info(f"All models loaded! GPU Memory: {torch.cuda.memory_allocated() / 1024**3:.1f}GB")
         
         return success
     
-    def optimize_memory(self):
+    def warmup(self):
+        """Compile each (width, height) bucket pair so the cost is not paid by requests"""
+        logger.info(f"Warming up compiled transformer for {ALLOWED_RES} x {ALLOWED_RES}...")
+        self.loading_status = "Warming up"
+        start = time.time()
+        # Width and height snap independently, so non-square pairs need their own graphs
+        for w in ALLOWED_RES:
+            for h in ALLOWED_RES:
+                self.generate_image("warmup", width=w, height=h, steps=4)
+        # Batched requests mostly arrive at the default size
+        for n in range(2, config.MAX_BATCH_SIZE + 1):
+            self.generate_images(["warmup"] * n, [-1] * n, width=config.DEFAULT_WIDTH, height=config.DEFAULT_HEIGHT, steps=4)
+        logger.info(f"Warm-up finished in {time.time() - start:.1f}s")
+    
+    def optimize_memory(self, force: bool = False):
         """Optimize GPU memory"""
-        gc.collect()
-        if torch.cuda.is_available():
+        if not torch.cuda.is_available():
+            gc.collect()
+            return
+        
+        # Releasing segments after every request just makes the allocator re-grow them
+        idle = torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+        if force or idle > config.EMPTY_CACHE_THRESHOLD:
+            gc.collect()
             torch.cuda.empty_cache()
             torch.cuda.synchronize()
     
+    def clip_fp16_activations(self):
+        """Clamp block outputs to the fp16 range; FLUX activations overflow in fp16 (diffusers #9097)"""
+        def clip_output(module, args, output):
+            if isinstance(output, tuple):
+                return tuple(o.clamp(-FP16_MAX, FP16_MAX) if torch.is_tensor(o) else o for o in output)
+            return output.clamp(-FP16_MAX, FP16_MAX)
+        
+        transformer = self.pipe.transformer
+        for block in list(transformer.transformer_blocks) + list(transformer.single_transformer_blocks):
+            block.register_forward_hook(clip_output)
+        logger.info("fp16 activation clipping enabled")
+    
+    def sdpa_context(self):
+        """Restrict SDPA to the fused Flash / mem-efficient kernels on CUDA"""
+        if config.ENABLE_SDPA and self.device == "cuda":
+            return torch.backends.cuda.sdp_kernel(
+                enable_flash=True,
+                enable_mem_efficient=True,
+                enable_math=False
+            )
+        return contextlib.nullcontext()
+    
+    def _encode_prompt(self, prompt: str):
+        """Encode a prompt with T5 + CLIP, reusing cached embeddings for repeated prompts"""
+        key = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+        with self.embed_lock:
+            cached = self.embed_cache.get(key)
+            if cached is not None:
+                self.embed_cache.move_to_end(key)
+                return cached
+        
+        with torch.inference_mode():
+            prompt_embeds, pooled_prompt_embeds, text_ids = self.pipe.encode_prompt(
+                prompt=prompt,
+                prompt_2=None,
+                device=self.device,
+                num_images_per_prompt=1
+            )
+        if self.t5_hook is not None:
+            self.t5_hook.offload()
+        
+        entry = (prompt_embeds, pooled_prompt_embeds, text_ids)
+        with self.embed_lock:
+            self.embed_cache[key] = entry
+            if len(self.embed_cache) > config.EMBED_CACHE_SIZE:
+                self.embed_cache.popitem(last=False)
+        return entry
+    
+    def _on_step_end(self, pipe, step: int, timestep, callback_kwargs):
+        """Per-step pipeline callback"""
+        if config.TORCH_COMPILE and config.CUDA_GRAPHS:
+            # Each step's transformer replay starts a new CUDA graph generation
+            torch.compiler.cudagraph_mark_step_begin()
+        return callback_kwargs
+    
     def generate_image(self, prompt: str, negative_prompt: str = "", **kwargs):
         """Generate image with enhanced prompts"""
-        if not self.model_loaded:
+        seed = kwargs.pop('seed', -1)
+        images, seeds = self.generate_images([prompt], [seed], negative_prompt, **kwargs)
+        return images, seeds[0]
+    
+    def generate_images(self, prompts: List[str], seeds: List[int], negative_prompt: str = "", **kwargs):
+        """Generate one image per prompt (or num_images for a single prompt) in one pipeline call"""
+        if not self.pipeline_ready:
             raise RuntimeError("Model not loaded")
         
         # Set defaults
@@ -297,29 +580,43 @@ class FluxKreaModelManager:
         guidance_scale = kwargs.get('guidance_scale', config.DEFAULT_GUIDANCE)
         width = kwargs.get('width', config.DEFAULT_WIDTH)
         height = kwargs.get('height', config.DEFAULT_HEIGHT)
-        seed = kwargs.get('seed', -1)
         num_images = kwargs.get('num_images', 1)
+        on_step: Optional[Callable[[int, int], None]] = kwargs.get('on_step')
+        
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            if on_step is not None:
+                on_step(step + 1, steps)
+            return self._on_step_end(pipe, step, timestep, callback_kwargs)
         
         # Handle seed
-        if seed == -1:
-            seed = torch.randint(0, 1000000, (1,)).item()
+        seeds = [torch.randint(0, 1000000, (1,)).item() if seed == -1 else seed for seed in seeds]
         
-        generator = torch.Generator(device=self.device).manual_seed(seed)
+        # One generator per prompt keeps each image identical to an unbatched run
+        generators = [gen.manual_seed(seed) for gen, seed in zip(self.generators, seeds)]
+        embeds = [self._encode_prompt(prompt) for prompt in prompts]
+        prompt_embeds = torch.cat([e[0] for e in embeds])
+        pooled_prompt_embeds = torch.cat([e[1] for e in embeds])
         
-        # Generate with autocast for performance
-        with torch.cuda.amp.autocast(enabled=True):
+        # Weights and inputs already share MODEL_DTYPE, so no autocast is needed
+        with self.sdpa_context():
             result = self.pipe(
-                prompt=prompt,
+                prompt_embeds=prompt_embeds,
+                pooled_prompt_embeds=pooled_prompt_embeds,
                 negative_prompt=negative_prompt,
                 num_inference_steps=steps,
                 guidance_scale=guidance_scale,
-                generator=generator,
+                generator=generators[0] if len(generators) == 1 else generators,
                 width=width,
                 height=height,
-                num_images_per_prompt=num_images
+                num_images_per_prompt=num_images,
+                callback_on_step_end=on_step_end,
+                output_type="pt"
             )
         
-        return result.images, seed
+        # Quantize on the GPU and copy the whole batch to the host once
+        u8 = result.images.mul_(255).round_().clamp_(0, 255).to(torch.uint8)
+        u8 = u8.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+        return [Image.fromarray(img) for img in u8], seeds
 
 # Initialize model manager globally
 def initialize_model_manager():
@@ -331,7 +628,8 @@ def initialize_model_manager():
 app = FastAPI(
     title="FLUX KREA Pro API",
     version="2.0.0",
-    description="Enhanced FLUX API with T5-XXL text encoder"
+    description="Enhanced FLUX API with T5-XXL text encoder",
+    default_response_class=ORJSONResponse
 )
 
 # Configure CORS
@@ -341,6 +639,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "X-Seed", "X-Duration"],
 )
 
 # Startup event
@@ -374,7 +673,7 @@ async def root():
             'CLIP ViT-L/14 encoder',
             'Batch generation up to 4 images',
             'Real-time progress tracking',
-            'xFormers memory optimization',
+            'SDPA / FlashAttention',
             'VAE slicing for HD images',
             'Queue-based processing',
             'Concurrent request handling'
@@ -385,6 +684,7 @@ async def root():
             'generate': '/generate',
             'batch': '/generate/batch',
             'progress': '/progress/{request_id}',
+            'progress_stream': '/progress/{request_id}/stream',
             'models': '/models'
         }
     }
@@ -418,6 +718,9 @@ async def status_check():
             'model_loaded': False
         }
     
+    with cache_lock:
+        active_requests = len([r for r in results_cache.values() if r.status == "processing"])
+    
     return {
         'status': model_manager.loading_status,
         'progress': model_manager.loading_progress,
@@ -426,11 +729,15 @@ async def status_check():
         'models_loading': not model_manager.model_loaded and model_manager.loading_progress > 0,
         'device': model_manager.device,
         'queue_size': generation_queue.qsize(),
-        'active_requests': len([r for r in results_cache.values() if r.status == "processing"]),
+        'active_requests': active_requests,
         'features': {
-            'xformers': config.ENABLE_XFORMERS,
+            'sdpa': config.ENABLE_SDPA,
             'vae_slicing': config.ENABLE_VAE_SLICING,
+            'vae_tiling': config.ENABLE_VAE_TILING,
+            'fused_qkv': config.FUSE_QKV and config.QUANT == "none",
             'torch_compile': config.TORCH_COMPILE,
+            'quant': config.QUANT,
+            't5_offload': model_manager.t5_hook is not None,
             't5_xxl': model_manager.t5_encoder is not None,
             'clip': model_manager.clip_model is not None
         }
@@ -447,8 +754,10 @@ async def generate_image(request: GenerateRequest):
     gen_request = GenerationRequest(
         id=request_id,
         prompt=request.prompt,
-        params=request.dict()
+        params=request
     )
+    gen_request.loop = asyncio.get_running_loop()
+    gen_request.future = gen_request.loop.create_future()
     
     # Add to queue
     try:
@@ -460,27 +769,37 @@ async def generate_image(request: GenerateRequest):
     
     # Wait for result (with timeout)
     timeout = 300  # 5 minutes
-    start_time = time.time()
-    
-    while time.time() - start_time < timeout:
-        if gen_request.status == "completed":
-            return GenerateResponse(
-                success=True,
-                request_id=request_id,
-                image=gen_request.result['images'][0] if gen_request.result else None,
-                seed=gen_request.result.get('seed'),
-                duration=gen_request.result.get('duration')
-            )
-        elif gen_request.status == "failed":
-            return GenerateResponse(
-                success=False,
-                error=gen_request.error
-            )
-        await asyncio.sleep(0.1)
+    try:
+        await asyncio.wait_for(gen_request.future, timeout=timeout)
+    except asyncio.TimeoutError:
+        return GenerateResponse(
+            success=False,
+            error="Generation timeout"
+        )
+    
+    if gen_request.status == "completed" and gen_request.image_bytes:
+        return Response(
+            content=gen_request.image_bytes[0],
+            media_type="image/png",
+            headers={
+                "X-Request-ID": request_id,
+                "X-Seed": str(gen_request.result['seed']),
+                "X-Duration": f"{gen_request.result['duration']:.3f}"
+            }
+        )
+    
+    if gen_request.status == "completed":
+        return GenerateResponse(
+            success=True,
+            request_id=request_id,
+            image=gen_request.result['images'][0] if gen_request.result else None,
+            seed=gen_request.result.get('seed'),
+            duration=gen_request.result.get('duration')
+        )
     
     return GenerateResponse(
         success=False,
-        error="Generation timeout"
+        error=gen_request.error
     )
 
 @app.post("/generate/batch")
@@ -493,9 +812,12 @@ async def generate_batch(request: BatchGenerateRequest):
     
     for prompt in request.prompts:
         request_id = str(uuid.uuid4())
-        params = request.dict()
-        params['prompt'] = prompt
-        params['num_images'] = 1
+        # Fields were validated on the batch model, so skip re-validation per prompt
+        params = GenerateRequest.model_construct(
+            prompt=prompt,
+            num_images=1,
+            **request.model_dump(exclude={'prompts'})
+        )
         
         gen_request = GenerationRequest(
             id=request_id,
@@ -529,14 +851,43 @@ async def get_progress(request_id: str):
     if not gen_request:
         raise HTTPException(404, "Request ID not found")
     
-    return ProgressResponse(
-        request_id=request_id,
-        status=gen_request.status,
-        progress=gen_request.progress,
-        created_at=gen_request.created_at,
-        result=gen_request.result,
-        error=gen_request.error
-    )
+    # Serialize directly; result can hold MB-sized base64 images
+    return ORJSONResponse(content={
+        'request_id': request_id,
+        'status': gen_request.status,
+        'progress': gen_request.progress,
+        'created_at': gen_request.created_at,
+        'result': gen_request.result,
+        'error': gen_request.error
+    })
+
+@app.get("/progress/{request_id}/stream")
+async def stream_progress(request_id: str):
+    """Stream generation progress as server-sent events"""
+    with cache_lock:
+        gen_request = results_cache.get(request_id)
+    
+    if not gen_request:
+        raise HTTPException(404, "Request ID not found")
+    
+    progress_queue = asyncio.Queue()
+    gen_request.loop = asyncio.get_running_loop()
+    gen_request.progress_queue = progress_queue
+    # Start with the current state, the request may already be finished
+    progress_queue.put_nowait(gen_request.snapshot())
+    
+    async def events():
+        while True:
+            try:
+                event = await asyncio.wait_for(progress_queue.get(), timeout=30)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: progress\ndata: {orjson.dumps(event).decode()}\n\n"
+            if event['status'] in ("completed", "failed"):
+                return
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 @app.get("/models")
 async def get_models():
@@ -566,6 +917,19 @@ async def get_models():
     }
 
 # Worker function
+def batch_key(gen_request: GenerationRequest):
+    """Requests with equal keys can share one pipeline call"""
+    params = gen_request.params
+    if params.num_images != 1:
+        return gen_request.id  # Multi-image requests run on their own
+    return (
+        params.steps,
+        params.width,
+        params.height,
+        params.cfg_guidance,
+        params.negative_prompt
+    )
+
 def generation_worker():
     """Process generation requests from queue"""
     logger.info(f"Worker {threading.current_thread().name} started")
@@ -578,83 +942,125 @@ def generation_worker():
             if gen_request is None:
                 break
             
-            logger.info(f"Processing request {gen_request.id}: {gen_request.prompt[:50]}...")
-            gen_request.status = "processing"
-            gen_request.started_at = time.time()
-            gen_request.progress = 10.0
+            # Collect whatever else arrives within the batching window
+            pending = [gen_request]
+            stop = False
+            deadline = time.time() + config.BATCH_WAIT
+            while len(pending) < config.MAX_BATCH_SIZE:
+                try:
+                    item = generation_queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                pending.append(item)
             
-            try:
-                # Generate image
-                params = gen_request.params
-                gen_request.progress = 30.0
-                
-                images, seed = model_manager.generate_image(
-                    prompt=params['prompt'],
-                    negative_prompt=params.get('negative_prompt', ''),
-                    steps=params['steps'],
-                    guidance_scale=params['cfg_guidance'],
-                    width=params['width'],
-                    height=params['height'],
-                    seed=params['seed'],
-                    num_images=params.get('num_images', 1)
-                )
-                
-                gen_request.progress = 80.0
-                
-                # Convert to base64
-                encoded_images = []
-                for img in images:
-                    buffered = io.BytesIO()
-                    img.save(buffered, format="PNG", optimize=True)
-                    img_base64 = base64.b64encode(buffered.getvalue()).decode()
-                    encoded_images.append(f"data:image/png;base64,{img_base64}")
-                
-                gen_request.completed_at = time.time()
-                duration = gen_request.completed_at - gen_request.started_at
-                
-                gen_request.result = {
-                    'images': encoded_images,
-                    'seed': seed,
-                    'duration': duration,
-                    'params': params
-                }
-                gen_request.status = "completed"
-                gen_request.progress = 100.0
-                
-                logger.info(f"Completed {gen_request.id} in {duration:.1f}s")
-                
-            except Exception as e:
-                logger.error(f"Generation error for {gen_request.id}: {e}")
-                gen_request.error = str(e)
-                gen_request.status = "failed"
-                gen_request.completed_at = time.time()
+            groups: Dict[Any, List[GenerationRequest]] = {}
+            for item in pending:
+                groups.setdefault(batch_key(item), []).append(item)
             
-            # Clean up old cache entries
-            cleanup_cache()
+            for group in groups.values():
+                process_group(group)
             
             # Memory cleanup
             if model_manager:
                 model_manager.optimize_memory()
             
+            if stop:
+                break
+            
         except queue.Empty:
             continue
         except Exception as e:
             logger.error(f"Worker error: {e}")
 
-def cleanup_cache():
-    """Clean up old cache entries"""
-    with cache_lock:
-        if len(results_cache) > config.RESULT_CACHE_SIZE:
-            # Sort by creation time and remove oldest
-            sorted_items = sorted(
-                results_cache.items(),
-                key=lambda x: x[1].created_at
-            )
-            
-            # Remove oldest 20%
-            to_remove = len(results_cache) - int(config.RESULT_CACHE_SIZE * 0.8)
-            for key, _ in sorted_items[:to_remove]:
-                del results_cache[key]
+def process_group(group: List[GenerationRequest]):
+    """Run a group of compatible requests through a single pipeline call"""
+    for gen_request in group:
+        logger.info(f"Processing request {gen_request.id}: {gen_request.prompt[:50]}...")
+        gen_request.status = "processing"
+        gen_request.started_at = time.time()
+        gen_request.progress = 30.0
+        gen_request.publish_progress()
+    if len(group) > 1:
+        logger.info(f"Batching {len(group)} requests into one pipeline call")
+    
+    def on_step(step: int, total: int):
+        # Denoising covers 30% -> 80%; encoding takes the rest
+        for gen_request in group:
+            gen_request.progress = 30.0 + 50.0 * step / total
+            gen_request.publish_progress()
+    
+    try:
+        # Generate images
+        params = group[0].params
+        num_images = params.num_images
+        images, seeds = model_manager.generate_images(
+            prompts=[r.params.prompt for r in group],
+            seeds=[r.params.seed for r in group],
+            negative_prompt=params.negative_prompt,
+            steps=params.steps,
+            guidance_scale=params.cfg_guidance,
+            width=params.width,
+            height=params.height,
+            num_images=num_images,
+            on_step=on_step
+        )
+    except Exception as e:
+        for gen_request in group:
+            logger.error(f"Generation error for {gen_request.id}: {e}")
+            gen_request.error = str(e)
+            gen_request.status = "failed"
+            gen_request.completed_at = time.time()
+            gen_request.notify_done()
+        return
+    
+    for i, gen_request in enumerate(group):
+        gen_request.progress = 80.0
+        gen_request.publish_progress()
+        encode_pool.submit(finish_request, gen_request, images[i * num_images:(i + 1) * num_images], seeds[i])
+
+def encode_png(img: Image.Image) -> bytes:
+    """Encode an image as PNG bytes"""
+    buffered = io.BytesIO()
+    # Fast zlib level; optimize=True costs hundreds of ms per 1024px image
+    img.save(buffered, format="PNG", compress_level=1)
+    return buffered.getvalue()
+
+def finish_request(gen_request: GenerationRequest, images: List[Image.Image], seed: int):
+    """Encode a request's images and publish the result (runs on encode_pool)"""
+    try:
+        png_images = [encode_png(img) for img in images]
+        
+        # Binary responses skip base64 entirely
+        if gen_request.params.response_format == "binary":
+            gen_request.image_bytes = png_images
+            encoded_images = []
+        else:
+            encoded_images = [f"data:image/png;base64,{base64.b64encode(png).decode()}" for png in png_images]
+        
+        gen_request.completed_at = time.time()
+        duration = gen_request.completed_at - gen_request.started_at
+        
+        gen_request.result = {
+            'images': encoded_images,
+            'seed': seed,
+            'duration': duration,
+            'params': gen_request.params.model_dump()
+        }
+        gen_request.status = "completed"
+        gen_request.progress = 100.0
+        
+        logger.info(f"Completed {gen_request.id} in {duration:.1f}s")
+        
+    except Exception as e:
+        logger.error(f"Generation error for {gen_request.id}: {e}")
+        gen_request.error = str(e)
+        gen_request.status = "failed"
+        gen_request.completed_at = time.time()
+    
+    gen_request.notify_done()
 
 def main():
     """Main entry point"""
@@ -687,9 +1093,14 @@ def main():
     print(f"  • T5-v1.1-XXL text encoder (11B parameters)")
     print(f"  • Batch generation support")
     print(f"  • Real-time progress tracking")
-    print(f"  • xFormers memory optimization")
+    print(f"  • SDPA / FlashAttention")
+    
+    # uvloop/httptools come with uvicorn[standard]; one process only, since each worker would load its own model
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    print(f"  • Event loop: {loop}, HTTP parser: {http}")
     
-    uvicorn.run(app, host=args.host, port=args.port)
+    uvicorn.run(app, host=args.host, port=args.port, loop=loop, http=http)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file